@@ -7,26 +7,83 @@ A Python module that processes recipe data from Excel files and generates summar
 """
 
 import argparse
+import hashlib
+import os
+import numpy as np
 import pandas as pd
 from pathlib import Path
 from lookups import temperature_lookup, duration_lookup
 import logging
+import operator
+import re
+from collections import defaultdict
+
+
+# Tokens for recipe_cost formulas: numbers, variable names, or any single other character
+FORMULA_TOKEN = re.compile(r'(\d+\.?\d*|\.\d+)|([A-Za-z_]\w*)|(\S)')
+BINARY_OPERATORS = {'+': operator.add, '-': operator.sub, '*': operator.mul, '/': operator.truediv}
+OPERATOR_PRECEDENCE = {'+': 1, '-': 1, '*': 2, '/': 2, 'neg': 3}
+
+# Per-user directory for parsed sheet caches, never the workbook's own directory
+CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'recipe_processor'
+
+# Columns written to the summary, in output order
+SUMMARY_COLUMNS = ['dish', 'recipe_cash_cost', 'temp_degC', 'time_mins', 'most_energy']
+
+# Word tokens for fuzzy matching lookup keys
+LOOKUP_TOKEN = re.compile(r'[a-z0-9]+')
 
 
 class LookupMatcher:
     """Helper class for bad/simple fuzzy matching lookup keys. Edit distance felt too complicated for this simple use case."""
     
     @staticmethod
-    def find_match(key, lookup_dict):
-        """Find a match for key in lookup_dict using substring matching."""
+    def prepare(lookup_dict):
+        """Build a lowercased key index for lookup_dict so find_match doesn't lowercase every key per call."""
+        return {str(lookup_key).lower(): lookup_key for lookup_key in lookup_dict}
+    
+    @staticmethod
+    def tokenize(key):
+        """Split a key into lowercase word tokens, e.g. 'Hot-Oven' -> ['hot', 'oven']."""
+        return LOOKUP_TOKEN.findall(str(key).lower())
+    
+    @staticmethod
+    def build_token_index(lookup_dict):
+        """Build an inverted index of token -> (position, key) for the lookup keys containing that token."""
+        token_index = defaultdict(list)
+        for position, lookup_key in enumerate(lookup_dict):
+            for token in dict.fromkeys(LookupMatcher.tokenize(lookup_key)):
+                token_index[token].append((position, lookup_key))
+        return dict(token_index)
+    
+    @staticmethod
+    def find_match(key, lookup_dict, prepared=None, token_index=None):
+        """Find a match for key in lookup_dict: exact, then case-insensitive, then (given token_index) the
+        earliest lookup key sharing a whole word with the key, then substring matching.
+        
+        A token hit wins over the substring scan, so multi-word keys can resolve differently than by
+        substring alone, e.g. 'Oven top' against ['hot oven', 'oven'] gives 'hot oven'."""
         # Direct lookup first
         if key in lookup_dict:
             return key
         
-        # Substring matching: check if key is in any of the lookup keys
+        if prepared is None:
+            prepared = LookupMatcher.prepare(lookup_dict)
+        
+        # Case-insensitive direct lookup
         key_lower = str(key).lower()
-        for lookup_key in lookup_dict:
-            if key_lower in lookup_key.lower() or lookup_key.lower() in key_lower:
+        if key_lower in prepared:
+            return prepared[key_lower]
+        
+        # Token matching: union of the key's token postings, earliest in lookup order wins
+        if token_index is not None:
+            candidates = [entry for token in LookupMatcher.tokenize(key) for entry in token_index.get(token, ())]
+            if candidates:
+                return min(candidates)[1]
+        
+        # Substring matching: check if key is in any of the lookup keys
+        for lookup_lower, lookup_key in prepared.items():
+            if key_lower in lookup_lower or lookup_lower in key_lower:
                 return lookup_key
         
         # No match found
@@ -36,13 +93,21 @@ class LookupMatcher:
 class RecipeProcessor:
     """Main class"""
     
-    def __init__(self, excel_file="recipe_book.xlsx", dry_run=False):
+    def __init__(self, excel_file="recipe_book.xlsx", dry_run=False, use_cache=True):
         self.excel_file = excel_file
         self.excel_file = Path(excel_file)
         self.dataframes = {}    # dict of dataframes for each sheet in the excel file
+        self.dish_work_df = None    # one row per dish with its lookup keys and every derived value
         self.temperature_lookup = temperature_lookup
         self.duration_lookup = duration_lookup
+        self._temp_lookup_lower = LookupMatcher.prepare(self.temperature_lookup)    # lowercased temperature keys for fuzzy matching
+        self._temp_tokens = LookupMatcher.build_token_index(self.temperature_lookup)    # token -> temperature keys
+        self._temp_cache = {}    # resolved temperature for each raw temperature key
         self.dry_run = dry_run
+        self.use_cache = use_cache    # reuse parsed sheets from the per-user cache directory
+        # one cache file per workbook, named from its absolute path
+        self.cache_file = CACHE_DIR / f"{hashlib.sha256(str(self.excel_file.resolve()).encode()).hexdigest()[:16]}.pkl"
+        self._rpn_cache = {}    # parsed postfix tokens for each recipe_cost formula
         self.logger = logging.getLogger(__name__)
         
         # Configure logging
@@ -54,92 +119,205 @@ class RecipeProcessor:
     def load_excel_sheets(self):
         """Load all sheets from the Excel file into separate dataframes."""
         try:
-            excel_file = pd.ExcelFile(self.excel_file)
-            self.dataframes = {sheet_name: pd.read_excel(self.excel_file, sheet_name=sheet_name) 
-                              for sheet_name in excel_file.sheet_names}
-            # for exploration, print the first 5 rows of each sheet
-            if self.dry_run:
+            # the workbook's mtime and size identify the version the cached sheets were parsed from
+            stat = self.excel_file.stat()
+            signature = (stat.st_mtime_ns, stat.st_size)
+            
+            # anything derived from previously loaded sheets is now stale
+            self.dish_work_df = None
+            
+            cached = self._read_cache(signature) if self.use_cache else None
+            if cached is not None:
+                self.dataframes = cached
+                self.logger.info(f"Loaded sheets from cache {self.cache_file}")
+            else:
+                # openpyxl is opened by pandas in read_only/data_only mode, so rows are streamed and cached values used
+                with pd.ExcelFile(self.excel_file, engine='openpyxl') as excel_file:
+                    # sheet_name=None reads every sheet in a single pass, keyed by sheet name
+                    self.dataframes = pd.read_excel(excel_file, sheet_name=None)
+                if self.use_cache and not self.dry_run:
+                    self._write_cache(signature)
+            # for exploration, print the first 5 rows of each sheet, skipped entirely if INFO isn't emitted
+            if self.dry_run and self.logger.isEnabledFor(logging.INFO):
                 for sheet_name, sheet_df in self.dataframes.items():
-                    self.logger.info(f"First 5 rows of {sheet_name}:")
-                    self.logger.info(sheet_df.head(5))
+                    self.logger.info("First 5 rows of %s:\n%s", sheet_name, sheet_df.head(5))
                     self.logger.info("-" * 50)
-                self.logger.info(f"Loaded {len(self.dataframes)} sheets: {list(self.dataframes.keys())}")
+                self.logger.info("Loaded %d sheets: %s", len(self.dataframes), list(self.dataframes.keys()))
         except Exception as e:
             self.logger.error(f"Error loading Excel file: {e}")
             raise
 
+    def _read_cache(self, signature):
+        """Return the cached sheets if the cache was written for this version of the excel file, else None."""
+        if not self.cache_file.exists():
+            return None
+        # the cache is a pickle, only load one this user wrote themselves
+        if hasattr(os, 'getuid') and self.cache_file.stat().st_uid != os.getuid():
+            self.logger.warning(f"Ignoring cache {self.cache_file} not owned by the current user")
+            return None
+        try:
+            cache = pd.read_pickle(self.cache_file)
+        except Exception as e:
+            self.logger.warning(f"Ignoring unreadable cache {self.cache_file}: {e}")
+            return None
+        if not isinstance(cache, dict) or 'signature' not in cache or not isinstance(cache.get('dataframes'), dict):
+            self.logger.warning(f"Ignoring malformed cache {self.cache_file}")
+            return None
+        if cache['signature'] != signature:
+            self.logger.info(f"Cache {self.cache_file} is stale, re-reading {self.excel_file}")
+            return None
+        return cache['dataframes']
+
+    def _write_cache(self, signature):
+        """Write the loaded sheets to the per-user cache, a failed write only costs the next run a re-parse."""
+        try:
+            CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+            pd.to_pickle({'signature': signature, 'dataframes': self.dataframes}, self.cache_file)
+        except Exception as e:
+            self.logger.warning(f"Could not write cache {self.cache_file}: {e}")
+
     def get_sheet(self, sheet_name):
         """Get a dataframe from the Excel file."""
         return self.dataframes[sheet_name]
     
     def calculate_recipe_costs(self):
-        """Calculate recipe costs using ingredient mapping and cost data."""
-        dish_df = self.get_sheet('dish')
+        """Calculate recipe costs using ingredient mapping and cost data, into the recipe_cash_cost column.
+        
+        Costs are written onto dish_work_df, so if it hasn't been built yet this builds it first,
+        which also runs the temperature and duration lookups for every dish."""
+        if self.dish_work_df is None:
+            self.build_dish_work()
         dish_ingredient_df = self.get_sheet('dish_ingredient')
         ingredient_cost_df = self.get_sheet('ingredient_cost')
         
         # Create cost lookup dictionary
         cost_lookup = dict(zip(ingredient_cost_df['ingredient'], ingredient_cost_df['cost']))
         
+        # Map costs onto ingredients in one pass, missing ingredients become NaN
+        ingredient_costs = dish_ingredient_df.assign(cost=dish_ingredient_df['ingredient'].map(cost_lookup))
+        missing = ingredient_costs[~ingredient_costs['ingredient'].isin(cost_lookup.keys())]
+        if not missing.empty and self.logger.isEnabledFor(logging.WARNING):
+            self.logger.warning("Missing ingredient costs: %s", missing[['dish', 'ingredient', 'ingredient_map']].to_dict('records'))
+
         # Create ingredient mapping for each dish
-        dish_ingredients = {}
-        for _, row in dish_ingredient_df.iterrows():
-            dish = row['dish']
-            ingredient = row['ingredient']
-            mapping = row['ingredient_map']
-            if dish not in dish_ingredients:
-                dish_ingredients[dish] = {}
-            
-            # Check if ingredient exists in cost lookup
-            if ingredient in cost_lookup:
-                dish_ingredients[dish][mapping] = cost_lookup[ingredient]
-            else:
-                self.logger.warning(f"Missing ingredient cost for '{ingredient}' in dish '{dish}' (mapped as '{mapping}')")
-                dish_ingredients[dish][mapping] = float('nan')
-        
-        # Calculate costs for each dish
-        recipe_costs = {}
-        for _, row in dish_df.iterrows():
-            dish = row['dish']
-            formula = row['recipe_cost']
+        dish_ingredients = {dish: dict(zip(group['ingredient_map'], group['cost'].tolist()))
+                            for dish, group in ingredient_costs.groupby('dish', sort=False)}
+
+        # Calculate costs for each dish, in dish_work_df row order
+        recipe_costs = []
+        for dish, formula in self.dish_work_df['formula'].items():
             ingredients = dish_ingredients.get(dish, {})
             
-            # Replace variables in formula with actual costs
             try:
-                # Replace A, B, etc. with actual values
-                formula_eval = formula
-                for var, cost in ingredients.items():
-                    formula_eval = formula_eval.replace(var, str(cost))
+                rpn = self._get_rpn(formula)
                 
-                self.logger.debug(f"Dish '{dish}': formula '{formula}' -> '{formula_eval}'")
-                
-                # Check if formula contains NaN
-                if 'nan' in formula_eval:
-                    self.logger.warning(f"Formula for '{dish}' contains missing ingredients: {formula_eval}")
-                    recipe_costs[dish] = float('nan')
+                # Short-circuit on missing ingredient costs (NaN is the only value not equal to itself),
+                # only when the formula actually uses one of them
+                missing_vars = [var for var, cost in ingredients.items() if cost != cost]
+                if missing_vars and any(kind == 'var' and value in missing_vars for kind, value in rpn):
+                    self.logger.warning(f"Formula for '{dish}' contains missing ingredients: {formula} missing {missing_vars}")
+                    recipe_cost = float('nan')
                 else:
-                    # Evaluate the formula safely
-                    recipe_costs[dish] = eval(formula_eval)
+                    # Evaluate the parsed formula against the ingredient costs
+                    recipe_cost = self._eval_rpn(rpn, ingredients)
             except Exception as e:
                 self.logger.error(f"Error evaluating formula for '{dish}': {e}")
-                recipe_costs[dish] = float('nan')
+                recipe_cost = float('nan')
+            recipe_costs.append(recipe_cost)
+        
+        self.dish_work_df['recipe_cash_cost'] = pd.Series(recipe_costs, index=self.dish_work_df.index, dtype='float64')
+        self.logger.info("Calculated recipe costs: %s", self.dish_work_df['recipe_cash_cost'])
+
+    def _get_rpn(self, formula):
+        """Parse a recipe_cost formula once and reuse the postfix tokens for every dish that shares it."""
+        rpn = self._rpn_cache.get(formula)
+        if rpn is None:
+            rpn = self._parse_formula(formula)
+            self._rpn_cache[formula] = rpn
+        return rpn
+
+    @staticmethod
+    def _parse_formula(formula):
+        """Convert an arithmetic formula like 'A/(A+B)' into postfix tokens using shunting-yard."""
+        output, stack = [], []
+        expect_operand = True    # distinguishes unary minus from subtraction
+        for number, name, symbol in FORMULA_TOKEN.findall(formula):
+            if (number or name or symbol == '(') and not expect_operand:
+                raise ValueError(f"Missing operator in formula '{formula}'")
+            if number:
+                output.append(('num', float(number)))
+                expect_operand = False
+            elif name:
+                output.append(('var', name))
+                expect_operand = False
+            elif symbol == '(':
+                stack.append(symbol)
+                expect_operand = True
+            elif symbol == ')':
+                while stack and stack[-1] != '(':
+                    output.append(('op', stack.pop()))
+                if not stack:
+                    raise ValueError(f"Unbalanced parentheses in formula '{formula}'")
+                stack.pop()
+                expect_operand = False
+            elif symbol in BINARY_OPERATORS:
+                if expect_operand and symbol == '-':
+                    stack.append('neg')
+                    continue
+                if expect_operand:
+                    raise ValueError(f"Unexpected operator '{symbol}' in formula '{formula}'")
+                # all binary operators are left associative, unary minus binds tighter than any of them
+                while stack and stack[-1] != '(' and OPERATOR_PRECEDENCE[stack[-1]] >= OPERATOR_PRECEDENCE[symbol]:
+                    output.append(('op', stack.pop()))
+                stack.append(symbol)
+                expect_operand = True
+            else:
+                raise ValueError(f"Unexpected character '{symbol}' in formula '{formula}'")
         
-        self.recipe_costs = recipe_costs
-        self.logger.info(f"Calculated recipe costs: {recipe_costs}")
+        while stack:
+            op = stack.pop()
+            if op == '(':
+                raise ValueError(f"Unbalanced parentheses in formula '{formula}'")
+            output.append(('op', op))
+        if expect_operand:
+            raise ValueError(f"Incomplete formula '{formula}'")
+        return output
+
+    @staticmethod
+    def _eval_rpn(rpn, variables):
+        """Evaluate postfix tokens against a {variable: value} mapping."""
+        stack = []
+        for kind, value in rpn:
+            if kind == 'num':
+                stack.append(value)
+            elif kind == 'var':
+                stack.append(variables[value])
+            elif value == 'neg':
+                stack.append(-stack.pop())
+            else:
+                right = stack.pop()
+                stack.append(BINARY_OPERATORS[value](stack.pop(), right))
+        return stack[0]
 
     # helper funcs to get temperature and duration from lookups.py, using substring matching for the temperature lookup
     def get_temperature(self, temp_key):
-        """Get temperature from lookups.py with substring matching."""
-        matched_key = LookupMatcher.find_match(temp_key, self.temperature_lookup)
+        """Get temperature from lookups.py with substring matching, resolving each key only once."""
+        if temp_key in self._temp_cache:
+            return self._temp_cache[temp_key]
+        
+        matched_key = LookupMatcher.find_match(temp_key, self.temperature_lookup, self._temp_lookup_lower, self._temp_tokens)
         
         if matched_key:
             if matched_key != temp_key:
-                self.logger.debug(f"Fuzzy matched temperature '{temp_key}' to '{matched_key}'")
-            return self.temperature_lookup[matched_key]
+                self.logger.debug("Fuzzy matched temperature '%s' to '%s'", temp_key, matched_key)
+            temp_degC = self.temperature_lookup[matched_key]
+        else:
+            # If match isn't found, return NaN, let downstream code handle the error
+            self.logger.warning(f"Temperature key '{temp_key}' not found. Available: {list(self.temperature_lookup.keys())}")
+            temp_degC = float('nan')
         
-        # If match isn't found, return NaN, let downstream code handle the error
-        self.logger.warning(f"Temperature key '{temp_key}' not found. Available: {list(self.temperature_lookup.keys())}")
-        return float('nan')
+        self._temp_cache[temp_key] = temp_degC
+        return temp_degC
 
     def get_duration_lookup(self, duration_key):
         """Get duration from lookups.py."""
@@ -149,71 +327,54 @@ class RecipeProcessor:
             self.logger.error(f"Duration key {duration_key} not found in duration lookup")
             return float('nan')
     
-    def calculate_energy_flags(self):
-        """Calculate energy values and identify the most energy dish."""
+    def build_dish_work(self):
+        """Build the per-dish working dataframe indexed by dish, every lookup value computed in one vectorised pass over the dish sheet."""
         dish_df = self.get_sheet('dish')
         
-        # calc energy for each dish (temp_degC * time_mins)
-        energies = {}
-        for _, row in dish_df.iterrows():
-            dish = row['dish']
-            temp_key = row['temperature']
-            duration_key = row['duration']
-            
-            temp_degC = self.get_temperature(temp_key)
-            time_mins = self.get_duration_lookup(duration_key)
-            
-            energy = temp_degC * time_mins
-            energies[dish] = energy
+        # Resolve each distinct lookup key once, then map the resolved values onto every dish
+        temps = {temp_key: self.get_temperature(temp_key) for temp_key in dish_df['temperature'].unique()}
+        durations = {duration_key: self.get_duration_lookup(duration_key) for duration_key in dish_df['duration'].unique()}
         
-        # Find the maximum energy
-        max_energy = max(energies.values())
+        dish_work_df = pd.DataFrame({
+            'formula': dish_df['recipe_cost'],
+            'temp_key': dish_df['temperature'],
+            'duration_key': dish_df['duration'],
+            'temp_degC': dish_df['temperature'].map(temps),
+            'time_mins': dish_df['duration'].map(durations),
+        })
+        dish_work_df.index = pd.Index(dish_df['dish'], name='dish')
         
-        # Create most_energy flags
-        self.most_energy_flags = {dish: (energy == max_energy) for dish, energy in energies.items()}
-        self.energies = energies
+        # energy is temp_degC * time_mins, flag the dish(es) with the maximum
+        # done on the raw float64 arrays, fmax skips NaN energies and initial covers an empty sheet
+        energy = dish_work_df['temp_degC'].to_numpy(dtype='float64') * dish_work_df['time_mins'].to_numpy(dtype='float64')
+        dish_work_df['energy'] = energy
+        dish_work_df['most_energy'] = energy == np.fmax.reduce(energy, initial=-np.inf)
         
-        self.logger.info(f"Energies: {energies}")
-        self.logger.info(f"Most energy flags: {self.most_energy_flags}")
-    
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info("Most energy dishes: %s", dish_work_df.index[dish_work_df['most_energy']].tolist())
+        self.dish_work_df = dish_work_df
     
     def generate_summary(self):
-        """Generate the final summary dataframe."""
-        dish_df = self.get_sheet('dish')
-        
-        summary_data = []
-        for _, row in dish_df.iterrows():
-            dish = row['dish']
-            temp_key = row['temperature']
-            duration_key = row['duration']
-            
-            # Get calculated values
-            recipe_cash_cost = self.recipe_costs.get(dish, float('nan'))
-            temp_degC = self.get_temperature(temp_key)
-            time_mins = self.get_duration_lookup(duration_key)
-            most_energy = self.most_energy_flags.get(dish, False)
-            
-            summary_data.append({
-                'dish': dish,
-                'recipe_cash_cost': recipe_cash_cost,
-                'temp_degC': temp_degC,
-                'time_mins': time_mins,
-                'most_energy': most_energy
-            })
-        
-        summary_df = pd.DataFrame(summary_data)
+        """Generate the final summary dataframe from the per-dish working dataframe."""
+        # recipe_cash_cost is only present once calculate_recipe_costs has filled it in
+        if self.dish_work_df is None or 'recipe_cash_cost' not in self.dish_work_df:
+            self.calculate_recipe_costs()
+        summary_df = self.dish_work_df.reset_index()[SUMMARY_COLUMNS].copy()
         self.logger.info(f"Generated summary with {len(summary_df)} rows")
         return summary_df
     
     
-    def save_to_csv(self, output_file="summary.csv"):
-        """Save the summary dataframe to CSV."""
+    def save_to_csv(self, output_file="summary.csv", summary_df=None):
+        """Save the summary dataframe to CSV, generating it only if one isn't passed in."""
         if self.dry_run:
             print(f"DRY RUN: Would save to {output_file}")
             return
         
         try:
-            summary_df = self.generate_summary()
+            if summary_df is None:
+                summary_df = self.generate_summary()
+            else:
+                summary_df = summary_df.copy()    # don't round the caller's dataframe
             
             # Round numeric columns for cleaner output and handle NaN display
             summary_df['recipe_cash_cost'] = summary_df['recipe_cash_cost'].round(2)
@@ -230,10 +391,10 @@ class RecipeProcessor:
         """Main processing pipeline."""
         print("Starting recipe processing...")
         self.load_excel_sheets()
+        self.build_dish_work()
         self.calculate_recipe_costs()
-        self.calculate_energy_flags()
         summary_df = self.generate_summary()
-        self.save_to_csv()
+        self.save_to_csv(summary_df=summary_df)
         self.logger.info("Processing complete!")
         return summary_df
 
@@ -244,11 +405,12 @@ def main():
     parser.add_argument('-e', '--execute', action='store_true', help='Run the program')
     parser.add_argument('--file', default='recipe_book.xlsx', help='Excel file to process')
     parser.add_argument('--dry-run', action='store_true', help='Dry run the program')
+    parser.add_argument('--no-cache', action='store_true', help='Always parse the Excel file, ignoring and not writing the sheet cache')
     
     args = parser.parse_args()
     
     if args.execute or args.dry_run:
-        processor = RecipeProcessor(excel_file=args.file, dry_run=args.dry_run)
+        processor = RecipeProcessor(excel_file=args.file, dry_run=args.dry_run, use_cache=not args.no_cache)
         processor.process()
     else:
         parser.print_help()